@@ -4,18 +4,68 @@ License, v. 2.0. If a copy of the MPL was not distributed with this
 file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """
 
+import asyncio
 import datetime
+import inspect
 import logging
-from typing import Any, Optional, Union
+import time
+from operator import attrgetter, countOf
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple, TypeVar, Union
 
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 
 
 __all__ = ('DefaultManager',)
 
 _log = logging.getLogger(__name__)
 
+T = TypeVar('T')
+
+
+async def _gather_with_concurrency(n: int, *coros: Awaitable[T]) -> List[T]:
+    semaphore = asyncio.Semaphore(n)
+
+    async def _wrap(coro: Awaitable[T]) -> T:
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(_wrap(c) for c in coros))
+
+
+def _count_bots(members: Iterable[discord.Member]) -> int:
+    return countOf(map(attrgetter('bot'), members), True)
+
+
+def _compile_limits(
+    min_age: Optional[datetime.timedelta], min_members: Optional[int], max_members: Optional[int]
+) -> Callable[[discord.Guild, datetime.datetime], bool]:
+    # Generates a predicate containing only the criteria that are actually set, so that
+    # disabled criteria cost nothing during a sweep. Guilds without a member count are
+    # passed through to the slower checks, which log the problem.
+    lines = ['def _fast_leave(guild, now):']
+    if min_age is not None:
+        lines += ['    if guild.created_at > now - MIN_AGE:', '        return True']
+    if min_members is not None or max_members is not None:
+        lines += ['    member_count = guild.member_count', '    if member_count is None:', '        return False']
+        if min_members is not None:
+            lines += ['    if member_count < MIN_MEMBERS:', '        return True']
+        if max_members is not None:
+            lines += ['    if member_count > MAX_MEMBERS:', '        return True']
+    lines.append('    return False')
+
+    namespace: Dict[str, Any] = {'MIN_AGE': min_age, 'MIN_MEMBERS': min_members, 'MAX_MEMBERS': max_members}
+    exec('\n'.join(lines), namespace)
+    return namespace['_fast_leave']
+
+
+def _to_seconds(name: str, value: Union[datetime.timedelta, int, float]) -> float:
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    elif isinstance(value, (int, float)):
+        return value
+    raise TypeError(f'expected {name} to be a datetime.timedelta or a number, got {value.__class__!r}')
+
 
 class DefaultManager(commands.Cog):
     """A guild manager used to leave guilds automatically under certain criteria.
@@ -97,8 +147,44 @@ class DefaultManager(commands.Cog):
         If this is set to `None`, the bot will not periodically check existing guilds for this leave criteria.
         If this is a :class:`datetime.timedelta`, it is interpreted as the duration between waves of checks.
         If this is a :class:`float`, it is interpreted as the number of seconds between waves of checks.
+
+        Note:
+            Waves of checks are skipped while none of the criteria above are set, unless
+            :meth:`self.leave_criteria` or :meth:`self.extra_criteria` is overridden.
+
+    min_frequency: Optional[Union[:class:`datetime.timedelta`, :class:`float`]]
+        The shortest time between waves of checks. Whenever a wave of checks leaves a guild, the
+        time until the next wave is reset to this value. Defaults to :attr:`frequency`.
+
+        :attr:`frequency` and this value must be positive, and this value must not be greater
+        than :attr:`max_frequency`.
+
+    max_frequency: Optional[Union[:class:`datetime.timedelta`, :class:`float`]]
+        The longest time between waves of checks. Each consecutive wave of checks that does not
+        leave any guilds doubles the time until the next wave, up to this value. Defaults to
+        :attr:`frequency`, which disables this behaviour.
+
+    max_concurrent_checks: :class:`int`
+        The maximum number of guilds checked concurrently during a periodic check. This only
+        matters if :meth:`self.whitelisted` or :meth:`self.extra_criteria` are coroutines that
+        perform I/O. Must be at least 1. Defaults to 8.
+
+    verdict_ttl: Optional[Union[:class:`datetime.timedelta`, :class:`float`]]
+        How long a guild that :meth:`self.leave_criteria` decided not to leave is exempt from
+        being checked again, as long as its member count has not changed. Cached results are
+        discarded whenever a guild is updated or left. If this is set to `None`, results are
+        never cached. Defaults to `None`.
+
+        Note:
+            Changes to the result of :meth:`self.whitelisted` and :meth:`self.extra_criteria`
+            may take up to this long to apply to guilds that have already been checked.
+            Changing the criteria attributes of this cog discards all cached results.
     """
 
+    # Member lists longer than this are counted in a worker thread so that the event loop
+    # is not blocked while a large guild is scanned.
+    _offload_threshold: int = 5000
+
     def __init__(
         self,
         bot: commands.Bot,
@@ -109,6 +195,10 @@ class DefaultManager(commands.Cog):
         max_bot_ratio: Optional[float] = None,
         min_guild_age: Optional[datetime.timedelta] = None,
         frequency: Optional[Union[datetime.timedelta, int, float]] = None,
+        min_frequency: Optional[Union[datetime.timedelta, int, float]] = None,
+        max_frequency: Optional[Union[datetime.timedelta, int, float]] = None,
+        max_concurrent_checks: int = 8,
+        verdict_ttl: Optional[Union[datetime.timedelta, int, float]] = None,
     ) -> None:
         self.bot = bot
         self.max_guilds = max_guilds
@@ -117,36 +207,159 @@ class DefaultManager(commands.Cog):
         self.max_bot_ratio = max_bot_ratio
         self.min_guild_age = min_guild_age
         self.frequency = frequency
+        self.min_frequency = min_frequency
+        self.max_frequency = max_frequency
+        self.max_concurrent_checks = max_concurrent_checks
+        self.verdict_ttl = verdict_ttl
+
+        if self.max_concurrent_checks < 1:
+            raise ValueError('max_concurrent_checks must be at least 1')
 
         self.__seconds: float = discord.utils.MISSING
         if self.frequency is not None:
-            if isinstance(self.frequency, datetime.timedelta):
-                self.__seconds = self.frequency.total_seconds()
-            elif isinstance(self.frequency, (int, float)):
-                self.__seconds = self.frequency
-            else:
-                raise TypeError(
-                    f'expected frequency to be a datetime.timedelta or a number, got {self.frequency.__class__!r}'
-                )
+            self.__seconds = _to_seconds('frequency', self.frequency)
+        self._min_seconds: float = self.__seconds
+        if self.min_frequency is not None:
+            self._min_seconds = _to_seconds('min_frequency', self.min_frequency)
+        self._max_seconds: float = self.__seconds
+        if self.max_frequency is not None:
+            self._max_seconds = _to_seconds('max_frequency', self.max_frequency)
+        if self.frequency is not None:
+            if self.__seconds <= 0 or self._min_seconds <= 0:
+                raise ValueError('frequency and min_frequency must be positive')
+            if self._min_seconds > self._max_seconds:
+                raise ValueError('min_frequency must not be greater than max_frequency')
+        self._empty_sweeps: int = 0
+        # The interval that consecutive empty sweeps double from
+        self._backoff_base: float = self.__seconds
+        self._current_interval: float = self.__seconds
+        self._stopped: bool = False
+        self._sweep_task: Optional['asyncio.Task[None]'] = None
+
+        self._verdict_ttl: Optional[float] = None if verdict_ttl is None else _to_seconds('verdict_ttl', verdict_ttl)
+        # guild ID -> (monotonic timestamp, member count) of the last check that did not leave it
+        self._verdict_cache: Dict[int, Tuple[float, Optional[int]]] = {}
+        # guild ID -> number of bots, kept up to date by member events. Only chunked guilds are
+        # cached, since member events cannot correct a count taken from a partial member list.
+        self._bot_counts: Dict[int, int] = {}
+        # Overrides that are not coroutine functions are called directly rather than through
+        # maybe_coroutine. They may still return an awaitable, which is awaited.
+        self._call_whitelisted: Optional[Callable[[discord.Guild], Union[bool, Awaitable[bool]]]] = (
+            None if inspect.iscoroutinefunction(self.whitelisted) else self.whitelisted
+        )
+        self._call_extra: Optional[Callable[[discord.Guild], Union[bool, Awaitable[bool]]]] = (
+            None if inspect.iscoroutinefunction(self.extra_criteria) else self.extra_criteria
+        )
+        # IDs of guilds that a missing member_count has already been logged for
+        self._warned: Set[int] = set()
+        # IDs of guilds being left, kept until the guild is removed from the cache
+        self._leaving: Set[int] = set()
+
+        # min_guild_age, min_members, max_members and max_bot_ratio, as last seen by _refresh_limits
+        self._limits_key: Tuple[Optional[datetime.timedelta], Optional[int], Optional[int], Optional[float]] = (
+            self.min_guild_age,
+            self.min_members,
+            self.max_members,
+            self.max_bot_ratio,
+        )
+        self._fast_leave: Callable[[discord.Guild, datetime.datetime], bool] = _compile_limits(
+            self.min_guild_age, self.min_members, self.max_members
+        )
 
     async def cog_load(self) -> None:
+        self._refresh_limits()
+        self._bot_counts = {}
+        for guild in self.bot.guilds:
+            if guild.chunked:
+                await self._seed_bot_count(guild)
         if self.__seconds is not discord.utils.MISSING:
-            self._check_guilds.change_interval(seconds=self.__seconds)
-            self._check_guilds.start()
+            self._stopped = False
+            self._current_interval = self._backoff_base = self.__seconds
+            self._empty_sweeps = 0
+            self._sweep_task = asyncio.create_task(self._sweep_forever())
 
     async def cog_unload(self) -> None:
-        if self.__seconds is not discord.utils.MISSING:
-            self._check_guilds.cancel()
-
-    @tasks.loop()
-    async def _check_guilds(self) -> None:
-        for guild in self.bot.guilds:
-            if await self.leave_criteria(guild):
-                await self.before_leave(guild, new=False)
+        self._stopped = True
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+
+    async def _sweep_forever(self) -> None:
+        while not self._stopped:
+            await asyncio.sleep(self._current_interval)
+            try:
+                await self._sweep_once()
+            except Exception:
+                _log.exception('Unhandled exception while checking guilds')
+
+    def _has_periodic_criteria(self) -> bool:
+        # Checked on every sweep, since the criteria may be changed after the cog is loaded
+        return any(x is not None for x in (self.min_members, self.max_members, self.max_bot_ratio, self.min_guild_age)) or (
+            type(self).leave_criteria is not DefaultManager.leave_criteria
+            or type(self).extra_criteria is not DefaultManager.extra_criteria
+        )
+
+    async def _sweep_once(self) -> None:
+        if not self._has_periodic_criteria():
+            return
+        now = discord.utils.utcnow()
+        # Unavailable guilds cannot be checked or left reliably, so they are skipped until they come back.
+        guilds = tuple(guild for guild in self.bot.guilds if not guild.unavailable)
+        self._refresh_limits()
+        if type(self).leave_criteria is DefaultManager.leave_criteria:
+            # Bind the criteria once per sweep rather than reading them from self for every guild.
+            check_one, ratio = self._check_one, self.max_bot_ratio
+            checks = (check_one(guild, now=now, ratio=ratio) for guild in guilds)
+        else:
+            # Overrides may use the documented (self, guild) signature, so now is not passed.
+            checks = (self.leave_criteria(guild) for guild in guilds)
+        verdicts = await _gather_with_concurrency(self.max_concurrent_checks, *checks)
+        to_leave = [guild for guild, verdict in zip(guilds, verdicts) if verdict]
+        await asyncio.gather(*(self._do_leave(guild, new=False) for guild in to_leave))
+        self._current_interval = self._next_interval(bool(to_leave))
+
+    async def _do_leave(self, guild: discord.Guild, *, new: bool, limit_reached: bool = False) -> None:
+        # A sweep decides which guilds to leave some time before it leaves them, so the guild
+        # may already have been left (or be in the middle of it) through another path.
+        if guild.id in self._leaving or self.bot.get_guild(guild.id) is None:
+            return
+        self._leaving.add(guild.id)
+        left = False
+        try:
+            # Hooks are user code; a failing hook must not keep the bot in the guild.
+            try:
+                if limit_reached:
+                    await self.on_guild_limit_reached(guild)
+                else:
+                    await self.before_leave(guild, new=new)
+            except Exception:
+                _log.exception('Ignoring exception in hook before leaving guild %s (ID: %s)', guild.name, guild.id)
+            try:
                 await guild.leave()
-                await self.after_leave(guild, new=False)
-
-    async def leave_criteria(self, guild: discord.Guild) -> bool:
+            except discord.HTTPException as e:
+                _log.warning('Failed to leave guild %s (ID: %s): %s', guild.name, guild.id, e)
+                return
+            left = True
+            try:
+                await self.after_leave(guild, new=new)
+            except Exception:
+                _log.exception('Ignoring exception in after_leave for guild %s (ID: %s)', guild.name, guild.id)
+        finally:
+            # On success the ID is kept until on_guild_remove, since the guild stays cached until then
+            if not left:
+                self._leaving.discard(guild.id)
+
+    def _next_interval(self, left_any: bool) -> float:
+        if left_any:
+            self._empty_sweeps = 0
+            self._backoff_base = self._min_seconds
+            return self._min_seconds
+        interval = self._backoff_base * 2**self._empty_sweeps
+        if interval < self._max_seconds:
+            self._empty_sweeps += 1
+        return max(self._min_seconds, min(interval, self._max_seconds))
+
+    async def leave_criteria(self, guild: discord.Guild, *, now: Optional[datetime.datetime] = None) -> bool:
         """Performs the logic determining whether a guild should be left.
 
         This typically shouldn't be overridden.
@@ -166,37 +379,104 @@ class DefaultManager(commands.Cog):
         -----------
         guild: :class:`discord.Guild`
             The guild being checked.
+        now: Optional[:class:`datetime.datetime`]
+            The time to check the guild age against. Defaults to the current time.
         """
-        if await discord.utils.maybe_coroutine(self.whitelisted, guild):
+        if now is None:
+            now = discord.utils.utcnow()
+        self._refresh_limits()
+        return await self._check_one(guild, now=now, ratio=self.max_bot_ratio)
+
+    def _refresh_limits(self) -> None:
+        key = (self.min_guild_age, self.min_members, self.max_members, self.max_bot_ratio)
+        if key != self._limits_key:
+            # Cached verdicts were computed under the old limits
+            self._verdict_cache.clear()
+            if key[:3] != self._limits_key[:3]:
+                self._fast_leave = _compile_limits(self.min_guild_age, self.min_members, self.max_members)
+            self._limits_key = key
+
+    async def _check_one(self, guild: discord.Guild, *, now: datetime.datetime, ratio: Optional[float]) -> bool:
+        verdict_ttl = self._verdict_ttl
+        if verdict_ttl is None:
+            return await self._leave_criteria(guild, now, ratio)
+
+        cached = self._verdict_cache.get(guild.id)
+        if cached is not None:
+            timestamp, member_count = cached
+            if member_count == guild.member_count and time.monotonic() - timestamp < verdict_ttl:
+                return False
+
+        # Only negative verdicts are cached: a positive verdict is acted on straight away, and
+        # must be checked again (including whitelisted) if the guild is still around.
+        verdict = await self._leave_criteria(guild, now, ratio)
+        if verdict:
+            self._verdict_cache.pop(guild.id, None)
+        else:
+            self._verdict_cache[guild.id] = (time.monotonic(), guild.member_count)
+        return verdict
+
+    async def _leave_criteria(self, guild: discord.Guild, now: datetime.datetime, ratio: Optional[float]) -> bool:
+        # The built-in criteria are cheap, so they run before any user code. whitelisted still
+        # runs before extra_criteria, so whitelisted guilds never reach extra_criteria.
+        if await self._breaks_limits(guild, now, ratio):
+            return not await self._is_whitelisted(guild)
+        if await self._is_whitelisted(guild):
             return False
-        if self.min_guild_age is not None and discord.utils.utcnow() - guild.created_at > self.min_guild_age:
+        if self._call_extra is None:
+            return await discord.utils.maybe_coroutine(self.extra_criteria, guild)
+        result = self._call_extra(guild)
+        if inspect.isawaitable(result):
+            return await result
+        return result
+
+    async def _is_whitelisted(self, guild: discord.Guild) -> bool:
+        if self._call_whitelisted is None:
+            return await discord.utils.maybe_coroutine(self.whitelisted, guild)
+        result = self._call_whitelisted(guild)
+        if inspect.isawaitable(result):
+            return await result
+        return result
+
+    async def _breaks_limits(self, guild: discord.Guild, now: datetime.datetime, ratio: Optional[float]) -> bool:
+        # Ordered by cost: the bot ratio check scans the member list, so it runs last.
+        if self._fast_leave(guild, now):
             return True
-        if self.min_members is not None:
-            if guild.member_count is None:
-                _log.warning(
-                    'member_count for guild %s (ID: %s) is None. Cannot check min_members criteria.', guild.name, guild.id
-                )
-            else:
-                if guild.member_count < self.min_members:
-                    return True
-        if self.max_members is not None:
-            if guild.member_count is None:
-                _log.warning(
-                    'member_count for guild %s (ID: %s) is None. Cannot check max_members criteria.', guild.name, guild.id
-                )
-            else:
-                if guild.member_count > self.max_members:
-                    return True
-        if self.max_bot_ratio is not None:
-            if guild.member_count is None:
-                _log.warning(
-                    'member_count for guild %s (ID: %s) is None. Cannot check max_bot_ratio criteria.', guild.name, guild.id
-                )
-            else:
-                bots = sum(m.bot for m in guild.members)
-                if bots / guild.member_count > self.max_bot_ratio:
-                    return True
-        return await discord.utils.maybe_coroutine(self.extra_criteria, guild)
+        member_count = guild.member_count
+        if member_count is None:
+            if self.min_members is not None or self.max_members is not None or ratio is not None:
+                self._warn_missing_member_count(guild)
+            return False
+        if ratio is not None:
+            bots = self._bot_counts.get(guild.id)
+            if bots is None:
+                bots = await self._seed_bot_count(guild)
+            if bots / member_count > ratio:
+                return True
+        return False
+
+    async def _seed_bot_count(self, guild: discord.Guild) -> int:
+        members = guild.members
+        if len(members) > self._offload_threshold:
+            loop = asyncio.get_running_loop()
+            bots = await loop.run_in_executor(None, _count_bots, members)
+        else:
+            bots = _count_bots(members)
+        if guild.chunked:
+            self._bot_counts[guild.id] = bots
+        else:
+            self._bot_counts.pop(guild.id, None)
+        return bots
+
+    def _warn_missing_member_count(self, guild: discord.Guild) -> None:
+        if guild.id in self._warned:
+            return
+        self._warned.add(guild.id)
+        _log.warning(
+            'member_count for guild %s (ID: %s) is None. Cannot check min_members, max_members or max_bot_ratio criteria.',
+            guild.name,
+            guild.id,
+        )
 
     def whitelisted(self, guild: discord.Guild, /) -> bool:
         """A method to determine whether a guild should not be left,
@@ -293,10 +573,34 @@ class DefaultManager(commands.Cog):
     @commands.Cog.listener('on_guild_join')
     async def _on_guild_join(self, guild: discord.Guild) -> Any:
         if len(self.bot.guilds) >= self.max_guilds:
-            await self.on_guild_limit_reached(guild)
-            await guild.leave()
-            await self.after_leave(guild)
+            await self._do_leave(guild, new=True, limit_reached=True)
         elif await self.leave_criteria(guild):
-            await self.before_leave(guild)
-            await guild.leave()
-            await self.after_leave(guild)
+            await self._do_leave(guild, new=True)
+
+    @commands.Cog.listener('on_guild_remove')
+    async def _on_guild_remove(self, guild: discord.Guild) -> None:
+        self._leaving.discard(guild.id)
+        self._verdict_cache.pop(guild.id, None)
+        self._bot_counts.pop(guild.id, None)
+        self._warned.discard(guild.id)
+
+    @commands.Cog.listener('on_guild_available')
+    async def _on_guild_available(self, guild: discord.Guild) -> None:
+        if guild.chunked:
+            await self._seed_bot_count(guild)
+        else:
+            self._bot_counts.pop(guild.id, None)
+
+    @commands.Cog.listener('on_member_join')
+    async def _on_member_join(self, member: discord.Member) -> None:
+        if member.guild.id in self._bot_counts:
+            self._bot_counts[member.guild.id] += member.bot
+
+    @commands.Cog.listener('on_member_remove')
+    async def _on_member_remove(self, member: discord.Member) -> None:
+        if member.guild.id in self._bot_counts:
+            self._bot_counts[member.guild.id] -= member.bot
+
+    @commands.Cog.listener('on_guild_update')
+    async def _on_guild_update(self, before: discord.Guild, after: discord.Guild) -> None:
+        self._verdict_cache.pop(after.id, None)